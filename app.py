@@ -2,12 +2,19 @@ import streamlit as st
 import os
 from dotenv import load_dotenv
 from groq import Groq
+import httpx
 import redis
-import json
+from redis.commands.search.field import TagField, VectorField
+from redis.commands.search.index_definition import IndexDefinition, IndexType
+from redis.commands.search.query import Query
+from cachetools import TTLCache
+from fastembed import TextEmbedding
+import numpy as np
 import time
 import uuid
 from datetime import datetime
 import hashlib
+import threading
 
 load_dotenv()
 
@@ -16,14 +23,42 @@ GROQ_MODEL         = "llama-3.3-70b-versatile"   # or "llama-3.1-70b-versatile"
 CACHE_TTL_SECONDS  = 30 * 60          # 30 min
 SEEN_TTL_SECONDS   = 24 * 60 * 60     # 24 h
 HISTORY_TTL_SECONDS = 7 * 24 * 60 * 60  # 7 days — feel free to adjust
+HISTORY_MAX_ITEMS  = 50               # entries kept per user
+LOCAL_CACHE_TTL_SECONDS = 5 * 60      # in-process summary cache
+SHORT_ANSWER_CHARS = 320              # answers this short are their own summary
+SHORT_SINGLE_LINE_CHARS = 500         # ...as are single-line answers under this
+EMBED_MODEL        = "sentence-transformers/all-MiniLM-L6-v2"
+EMBED_DIM          = 384
+SEMCACHE_INDEX     = "semcache_idx"
+SEMCACHE_MIN_SIMILARITY = 0.9         # cosine similarity needed to reuse a summary
 
 # ──── Groq Client ───────────────────────────────────────────────────────────
 @st.cache_resource
 def get_groq_client():
-    return Groq(api_key=os.getenv("GROQ_API_KEY"))
+    # One shared keep-alive HTTP/2 pool, so calls across reruns/users skip the TLS handshake
+    http_client = httpx.Client(
+        http2=True,
+        timeout=60.0,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+    )
+    return Groq(api_key=os.getenv("GROQ_API_KEY"), http_client=http_client)
 
 groq_client = get_groq_client()
 
+def is_short_answer(text: str) -> bool:
+    """Short answers are used as their own summary, skipping the second Groq call."""
+    return len(text) <= SHORT_ANSWER_CHARS or (
+        "\n" not in text and len(text) < SHORT_SINGLE_LINE_CHARS
+    )
+
+def stream_text(resp, meta: dict):
+    """Yield content deltas from a streamed completion; Groq sends usage on the last chunk."""
+    for chunk in resp:
+        if chunk.x_groq is not None and chunk.x_groq.usage is not None:
+            meta["usage"] = chunk.x_groq.usage
+        if chunk.choices:
+            yield chunk.choices[0].delta.content or ""
+
 # ──── Redis Client ──────────────────────────────────────────────────────────
 @st.cache_resource
 def get_redis_client():
@@ -31,7 +66,7 @@ def get_redis_client():
         host=os.getenv("REDIS_HOST", "localhost"),
         port=int(os.getenv("REDIS_PORT", 6379)),
         db=int(os.getenv("REDIS_DB", 0)),
-        decode_responses=True
+        decode_responses=False   # raw bytes; decode only what gets displayed
     )
     try:
         client.ping()
@@ -42,10 +77,49 @@ def get_redis_client():
 
 redis_client = get_redis_client()
 
+# Read summary + seen marker and, when both exist, slide both TTLs — atomically, one RTT
+LOOKUP_AND_TOUCH_LUA = """
+local s = redis.call('GET', KEYS[1])
+local e = redis.call('EXISTS', KEYS[2])
+if s and e == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+end
+return {s, e}
+"""
+
+@st.cache_resource
+def get_lookup_script():
+    script = redis_client.register_script(LOOKUP_AND_TOUCH_LUA)
+    redis_client.script_load(LOOKUP_AND_TOUCH_LUA)   # so pipelined EVALSHA finds it
+    return script
+
+lookup_script = get_lookup_script()
+
+# ──── Local Summary Cache ───────────────────────────────────────────────────
+# Hot summaries kept in-process so repeat asks on this worker skip Redis.
+# Only holds summaries whose "seen" marker also existed, so a hit is a repeat.
+@st.cache_resource
+def get_local_summary_cache():
+    return TTLCache(maxsize=512, ttl=LOCAL_CACHE_TTL_SECONDS), threading.Lock()
+
+_summary_local, _summary_local_lock = get_local_summary_cache()
+
+def get_local_summary(key: str):
+    with _summary_local_lock:
+        return _summary_local.get(key)
+
+def set_local_summary(key: str, summary: str):
+    with _summary_local_lock:
+        _summary_local[key] = summary
+
 # ──── Hash Helpers ──────────────────────────────────────────────────────────
-def make_query_hash(q: str) -> str:
-    cleaned = " ".join(q.strip().lower().split())
-    return hashlib.sha256(cleaned.encode()).hexdigest()[:16]
+def normalize_question(q: str) -> str:
+    return " ".join(q.lower().split())
+
+def make_query_hash(normalized: str) -> str:
+    # Expects normalize_question() output — normalize once per question, not per call
+    return hashlib.blake2b(normalized.encode(), digest_size=8).hexdigest()
 
 def summary_cache_key(username: str, q_hash: str) -> str:
     return f"cache:{username}:summary:{q_hash}"
@@ -54,36 +128,120 @@ def seen_key(username: str, q_hash: str) -> str:
     return f"cache:{username}:seen:{q_hash}"
 
 def history_key(username: str) -> str:
-    return f"history:{username}"
+    return f"hist:{username}"
+
+def last_write_key(username: str) -> str:
+    return f"last:{username}"
 
 # ──── History Helpers ───────────────────────────────────────────────────────
-def save_to_history(username: str, question: str, summary: str):
+def save_to_history(username: str, question: str, summary: str, pipe=None):
     key = history_key(username)
-    ts = time.time()
-    msg = {
-        "ts": ts,
-        "time": datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M"),
-        "question": question,
-        "summary": summary,
-    }
-    redis_client.zadd(key, {json.dumps(msg): -ts})   # negative for DESC order
-    redis_client.expire(key, HISTORY_TTL_SECONDS)
-
-def load_history(username: str):
-    key = history_key(username)
-    items = redis_client.zrevrange(key, 0, 49)  # last 50 items max
-    return [json.loads(item) for item in items if item]
+    # Queue on the caller's pipeline if given, otherwise send both in one RTT
+    own_pipe = pipe is None
+    if own_pipe:
+        pipe = redis_client.pipeline(transaction=False)
+    # Capped stream: the entry ID carries the timestamp, MAXLEN ~ trims old entries
+    pipe.xadd(key, {"q": question, "s": summary}, maxlen=HISTORY_MAX_ITEMS, approximate=True)
+    pipe.expire(key, HISTORY_TTL_SECONDS)
+    pipe.set(last_write_key(username), time.time(), ex=HISTORY_TTL_SECONDS)   # busts load_history cache
+    if own_pipe:
+        pipe.execute()
+
+@st.cache_data(ttl=30, show_spinner=False)
+def load_history(username: str, last_write_ts):
+    # last_write_ts is only part of the cache key: a new write means a new entry
+    items = redis_client.xrevrange(history_key(username), count=HISTORY_MAX_ITEMS)  # newest first
+    return [
+        {
+            "ts": int(entry_id.split(b"-")[0]) / 1000,   # stream IDs are <ms>-<seq>
+            "question": fields[b"q"].decode(),
+            "summary": fields[b"s"].decode(),
+        }
+        for entry_id, fields in items
+    ]
 
 def clear_history(username: str):
-    redis_client.delete(history_key(username))
+    with redis_client.pipeline(transaction=False) as pipe:
+        pipe.delete(history_key(username))
+        pipe.set(last_write_key(username), time.time(), ex=HISTORY_TTL_SECONDS)
+        pipe.execute()
+
+# ──── Semantic Cache Helpers ────────────────────────────────────────────────
+# Paraphrases miss the exact-hash cache, so each answered question also stores
+# its embedding in a RediSearch HNSW index pointing at its summary key.
+def semcache_key(username: str, q_hash: str) -> str:
+    return f"semcache:{username}:{q_hash}"
+
+@st.cache_resource
+def ensure_semcache_index() -> bool:
+    """Create the vector index once; False when Redis has no search module."""
+    index = redis_client.ft(SEMCACHE_INDEX)
+    try:
+        index.info()
+        return True
+    except redis.ResponseError:
+        pass
+    try:
+        index.create_index(
+            [
+                TagField("user"),
+                VectorField("embedding", "HNSW", {
+                    "TYPE": "FLOAT32",
+                    "DIM": EMBED_DIM,
+                    "DISTANCE_METRIC": "COSINE",
+                }),
+            ],
+            definition=IndexDefinition(prefix=["semcache:"], index_type=IndexType.HASH),
+        )
+        return True
+    except redis.ResponseError:
+        return False
+
+@st.cache_resource
+def get_embedder():
+    """Load the embedding model up front; None disables the semantic tier."""
+    if not ensure_semcache_index():
+        return None
+    try:
+        # Downloads the ONNX model on first use — keep that off the question path
+        return TextEmbedding(EMBED_MODEL)
+    except Exception:
+        return None
+
+embedder = get_embedder()
+
+def embed_question(question: str) -> bytes:
+    vec = next(iter(embedder.embed([question])))
+    return np.asarray(vec, dtype=np.float32).tobytes()
+
+def find_similar_summary_key(username: str, embedding: bytes):
+    query = (
+        Query(f"(@user:{{{username}}})=>[KNN 1 @embedding $vec AS dist]")
+        .return_fields("summary_key", "dist")
+        .dialect(2)
+    )
+    res = redis_client.ft(SEMCACHE_INDEX).search(query, query_params={"vec": embedding})
+    if not res.docs:
+        return None
+    doc = res.docs[0]
+    # COSINE distance = 1 - similarity
+    if 1 - float(doc.dist) < SEMCACHE_MIN_SIMILARITY:
+        return None
+    return doc.summary_key
+
+def save_to_semcache(username: str, q_hash: str, embedding: bytes, summary_key: str, pipe):
+    key = semcache_key(username, q_hash)
+    pipe.hset(key, mapping={"user": username, "embedding": embedding, "summary_key": summary_key})
+    pipe.expire(key, CACHE_TTL_SECONDS)   # never outlive the summary it points to
 
 # ──── Usage Score Helpers ───────────────────────────────────────────────────
 def usage_score_key(username: str) -> str:
     return f"usage_score:{username}"
 
-def add_usage_score(username: str, prompt_tokens: int, completion_tokens: int):
+def add_usage_score(username: str, prompt_tokens: int, completion_tokens: int, pipe=None):
     fake_cost = (prompt_tokens + completion_tokens) * 10
-    redis_client.incrbyfloat(usage_score_key(username), fake_cost)
+    client = redis_client if pipe is None else pipe
+    client.incrbyfloat(usage_score_key(username), fake_cost)
 
 def get_usage_score(username: str) -> int:
     val = redis_client.get(usage_score_key(username))
@@ -122,8 +280,7 @@ with st.sidebar:
 
         if st.button("🗑️ Clear my history", use_container_width=True):
             clear_history(st.session_state.username)
-            st.success("History cleared")
-            time.sleep(0.8)
+            st.toast("History cleared", icon="🗑️")
             st.rerun()
 
     else:
@@ -163,8 +320,7 @@ if not st.session_state.authenticated:
             if authenticate(username, password):
                 st.session_state.username = username.strip().lower()
                 st.session_state.authenticated = True
-                st.success(f"Welcome back, {st.session_state.username}!")
-                time.sleep(0.6)
+                st.toast(f"Welcome back, {st.session_state.username}!", icon="✅")
                 st.rerun()
             else:
                 st.error("Invalid username or password")
@@ -176,67 +332,131 @@ USERNAME = st.session_state.username
 
 st.subheader(f"Hi {USERNAME.capitalize()}, ask anything…")
 
-# Show recent history
-history = load_history(USERNAME)
+# ── Main chat input ─────────────────────────────────────────────────────────
+question = st.chat_input("Your question…")
+
+if question:
+    question = question.strip()
+    if not question:
+        st.rerun()
+    q_norm = normalize_question(question)
+
+# One round-trip per rerun: history version + (if a question is pending) cache lookups
+pipe = redis_client.pipeline(transaction=False)
+pipe.get(last_write_key(USERNAME))
+if question:
+    q_hash = make_query_hash(q_norm)
+    summary_key = f"cache:{USERNAME}:summary:{q_hash}"
+    seen_key   = f"cache:{USERNAME}:seen:{q_hash}"
+    local_summary = get_local_summary(summary_key)
+    if local_summary is None:
+        # Plain EVALSHA: passing client=pipe would add a SCRIPT EXISTS round-trip per execute
+        pipe.evalsha(lookup_script.sha, 2, summary_key, seen_key, CACHE_TTL_SECONDS, SEEN_TTL_SECONDS)
+try:
+    results = pipe.execute()
+except redis.exceptions.NoScriptError:
+    # Server script cache was flushed — calling the Script object reloads it
+    results = [
+        redis_client.get(last_write_key(USERNAME)),
+        lookup_script(keys=[summary_key, seen_key], args=[CACHE_TTL_SECONDS, SEEN_TTL_SECONDS]),
+    ]
+
+# Show recent history — Redis is only read again after a new write
+history = load_history(USERNAME, results[0])
 if history:
     with st.expander("Recent conversations (latest first)", expanded=False):
         for item in history:
+            item_time = datetime.fromtimestamp(item["ts"]).strftime("%Y-%m-%d %H:%M")
             with st.chat_message("user", avatar="🧑‍💻"):
-                st.caption(item["time"])
+                st.caption(item_time)
                 st.markdown(item["question"])
             with st.chat_message("assistant", avatar="🤖"):
-                st.caption(item["time"] + " • Summary")
+                st.caption(item_time + " • Summary")
                 st.markdown(item["summary"])
 
-# ── Main chat input ─────────────────────────────────────────────────────────
-question = st.chat_input("Your question…")
-
 if question:
-    question = question.strip()
-    if not question:
-        st.rerun()
-
     current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     
     with st.chat_message("user"):
         st.caption(current_time)
         st.markdown(question)
 
-    q_hash = make_query_hash(question)
-    summary_key = f"cache:{USERNAME}:summary:{q_hash}"
-    seen_key   = f"cache:{USERNAME}:seen:{q_hash}"
-
-    cached_summary = redis_client.get(summary_key)
-    has_seen_full  = redis_client.exists(seen_key)  # exists → already saw full once
+    if local_summary is not None:
+        cached_summary, has_seen_full = local_summary, True
+    else:
+        cached_summary, seen_exists = results[1]
+        cached_summary = cached_summary.decode() if cached_summary is not None else None
+        has_seen_full  = seen_exists == 1   # exists → already saw full once
+        if cached_summary and has_seen_full:
+            set_local_summary(summary_key, cached_summary)
+
+    # Exact miss → look for a paraphrase of an earlier question
+    question_emb = None
+    is_similar = False
+    if not (cached_summary and has_seen_full) and embedder is not None:
+        try:
+            question_emb = embed_question(question)
+            similar_key = find_similar_summary_key(USERNAME, question_emb)
+            similar_summary = redis_client.get(similar_key) if similar_key else None
+            if similar_summary is not None:
+                cached_summary, has_seen_full = similar_summary.decode(), True
+                is_similar = True
+        except Exception:
+            # Embedding or vector search failed — fall back to the exact-hash path
+            question_emb = None
 
     if cached_summary and has_seen_full:
         # ── Repeat ask → show only cached summary ───────────────────────
         with st.chat_message("assistant"):
             st.caption(f"{current_time} • Short summary (repeat)")
-            st.info("→ Same question asked before → showing concise summary")
+            if is_similar:
+                st.info("→ Similar question asked before → showing concise summary")
+            else:
+                st.info("→ Same question asked before → showing concise summary")
             st.markdown(cached_summary)
 
         # Still log to history (only summary)
-        save_to_history(USERNAME, question, cached_summary)
+        with redis_client.pipeline(transaction=False) as pipe:
+            save_to_history(USERNAME, question, cached_summary, pipe=pipe)
+            pipe.execute()
 
     else:
         # ── First time this question → generate & show full answer ───────
-        with st.spinner("Generating full detailed answer..."):
+        # Stream the **full** answer (only this time) as tokens arrive
+        with st.chat_message("assistant"):
+            st.caption(f"{current_time} • Full detailed answer")
             try:
-                full_resp = groq_client.chat.completions.create(
+                full_stream = groq_client.chat.completions.create(
                     model=GROQ_MODEL,
                     messages=[{"role": "user", "content": question}],
                     temperature=0.7,
                     max_tokens=2048,
+                    stream=True,
                 )
-                full_text = full_resp.choices[0].message.content.strip()
-                full_usage = full_resp.usage
+                stream_meta = {}
+                full_text = st.write_stream(stream_text(full_stream, stream_meta)).strip()
+            except Exception as e:
+                # Keep whatever already streamed on screen — a rerun would wipe it
+                st.error(f"Groq error: {e}")
+                st.stop()
 
-                # Create very short summary
-                summary_prompt = (
-                    "Create an extremely concise summary in **1–3 short sentences maximum**. "
-                    "No examples, no lists, no code blocks, be as brief as possible:\n\n" + full_text
-                )
+            st.caption("↑ This full version is shown only once — next time you'll see only summary")
+
+        # The answer has been shown, so its tokens count even if the summary fails
+        full_usage = stream_meta.get("usage")
+        if full_usage is not None:
+            add_usage_score(USERNAME, full_usage.prompt_tokens, full_usage.completion_tokens)
+
+        summary_usage = None
+        if is_short_answer(full_text):
+            summary_text = full_text
+        else:
+            # Create very short summary
+            summary_prompt = (
+                "Create an extremely concise summary in **1–3 short sentences maximum**. "
+                "No examples, no lists, no code blocks, be as brief as possible:\n\n" + full_text
+            )
+            try:
                 summary_resp = groq_client.chat.completions.create(
                     model=GROQ_MODEL,
                     messages=[{"role": "user", "content": summary_prompt}],
@@ -245,27 +465,26 @@ if question:
                 )
                 summary_text = summary_resp.choices[0].message.content.strip()
                 summary_usage = summary_resp.usage
-
-                # Accumulate usage score for both API calls
-                total_prompt = full_usage.prompt_tokens + summary_usage.prompt_tokens
-                total_completion = full_usage.completion_tokens + summary_usage.completion_tokens
-                add_usage_score(USERNAME, total_prompt, total_completion)
-
-                # Cache **only** the summary + mark that full was shown
-                redis_client.setex(summary_key, CACHE_TTL_SECONDS, summary_text)
-                redis_client.setex(seen_key, SEEN_TTL_SECONDS, "1")
-
             except Exception as e:
-                st.error(f"Groq error: {e}")
-                st.rerun()
-
-        # Show **full** answer (only this time)
-        with st.chat_message("assistant"):
-            st.caption(f"{current_time} • Full detailed answer")
-            st.markdown(full_text)
-            st.caption("↑ This full version is shown only once — next time you'll see only summary")
-
-        # Log summary to history (consistent with repeat case)
-        save_to_history(USERNAME, question, summary_text)
+                st.error(f"Groq error while summarizing: {e}")
+                summary_text = None
+
+        with redis_client.pipeline(transaction=False) as pipe:
+            if summary_usage is not None:
+                add_usage_score(USERNAME, summary_usage.prompt_tokens, summary_usage.completion_tokens, pipe=pipe)
+            if summary_text is not None:
+                # Cache **only** the summary + mark that full was shown, and log
+                # summary to history (consistent with repeat case) — one round-trip
+                pipe.setex(summary_key, CACHE_TTL_SECONDS, summary_text)
+                pipe.setex(seen_key, SEEN_TTL_SECONDS, "1")
+                save_to_history(USERNAME, question, summary_text, pipe=pipe)
+                if question_emb is not None:
+                    save_to_semcache(USERNAME, q_hash, question_emb, summary_key, pipe)
+            else:
+                # No summary to cache — next ask regenerates; still log a truncated answer
+                save_to_history(USERNAME, question, full_text[:SHORT_ANSWER_CHARS].rstrip() + "…", pipe=pipe)
+            pipe.execute()
+        if summary_text is not None:
+            set_local_summary(summary_key, summary_text)
 
     #st.rerun()
\ No newline at end of file